@@ -1,18 +1,74 @@
+import orjson
 import requests
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Optional, Dict, Any, List
 from urllib.parse import urljoin
 
 class AmberClient:
+    # Keep-alive connections per host; also caps concurrent requests
+    POOL_SIZE = 8
+    # Responses kept for conditional GETs (ETag / Last-Modified)
+    VALIDATOR_CACHE_SIZE = 64
+    # Fail fast on an unreachable host, but give large usage ranges time to arrive
+    TIMEOUT = (3.05, 15)
+
     def __init__(self, base_url: str, api_key: str):
         self.base_url = base_url.rstrip('/') + '/'
+        self.api_key = api_key
         self.session = requests.Session()
-        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "User-Agent": "Amber-Dashboard/1.0",
+        })
+        # Keep connections alive between calls and retry transient failures
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_SIZE,
+            pool_maxsize=self.POOL_SIZE,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self._validated = OrderedDict()
+        self._validated_lock = threading.Lock()
 
     def _get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
         url = urljoin(self.base_url, path.lstrip('/'))
-        r = self.session.get(url, params=params, timeout=30)
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._validated_lock:
+            cached = self._validated.get(key)
+
+        # Settled history doesn't change, so let the server answer 304 and
+        # reuse the body we already parsed
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        r = self.session.get(url, params=params, headers=headers, timeout=self.TIMEOUT)
+        if r.status_code == 304 and cached:
+            return cached[2]
         r.raise_for_status()
-        return r.json()
+        data = orjson.loads(r.content)
+
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if etag or last_modified:
+            with self._validated_lock:
+                self._validated[key] = (etag, last_modified, data)
+                self._validated.move_to_end(key)
+                while len(self._validated) > self.VALIDATOR_CACHE_SIZE:
+                    self._validated.popitem(last=False)
+        return data
 
     def sites(self) -> List[Dict[str, Any]]:
         # Expected path (based on docs/community refs): /sites
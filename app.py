@@ -1,55 +1,147 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import Flask, g, render_template, request, redirect, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
-from models import db, Interval, UserConfig
-from fetcher import pull_once
+import logging
+import threading
+import config
+from models import db, Agg, Interval, UserConfig
+from fetcher import forget_site_id, pull_once, rebuild_aggregates
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s"
+)
+logger = logging.getLogger("amber")
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///amber.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
+
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets the dashboard keep reading while a pull is writing
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
+
+
 # --- Initialize database safely for Flask 3.x ---
 with app.app_context():
+    event.listen(db.engine, "connect", _sqlite_pragmas)
     db.create_all()
     if not UserConfig.query.get(1):
         user = UserConfig(id=1, api_key="", site_id=None)
         db.session.add(user)
         db.session.commit()
+    # Databases created before the Agg rollup existed need a one-off backfill
+    if not Agg.query.first() and Interval.query.first():
+        rebuild_aggregates()
 
 
-@app.route("/")
-def index():
-    # Latest 48 intervals (~24 hours)
-    intervals = Interval.query.order_by(Interval.ts.desc()).limit(48).all()
+def current_user():
+    """The singleton UserConfig, loaded at most once per request."""
+    if "uc" not in g:
+        g.uc = UserConfig.query.get(1)
+        if g.uc is None:
+            g.uc = UserConfig(id=1, api_key="", site_id=None)
+            db.session.add(g.uc)
+    return g.uc
+
 
-    # Daily aggregation
+# Dashboard summaries only change when a pull lands, so keep the last
+# result around and key it on the newest interval timestamp.
+_agg_cache = {}
+
+
+def _get_agg():
+    latest = db.session.query(db.func.max(Interval.ts)).scalar()
+    if "val" in _agg_cache and _agg_cache.get("key") == latest:
+        return _agg_cache["val"]
+
+    # Daily totals straight from the materialized Agg rollup
     daily = (
         db.session.query(
-            db.func.date(Interval.ts).label("day"),
-            db.func.sum(Interval.import_kwh).label("import_kwh"),
-            db.func.sum(Interval.export_kwh).label("export_kwh"),
-            db.func.sum(Interval.cost).label("net_cost"),
+            Agg.date.label("day"),
+            Agg.import_kwh,
+            Agg.export_kwh,
+            Agg.cost.label("net_cost"),
         )
-        .group_by(db.func.date(Interval.ts))
-        .order_by(db.func.date(Interval.ts).desc())
+        .order_by(Agg.date.desc())
+        .limit(90)
         .all()
     )
 
-    # Monthly aggregation
+    # Monthly aggregation over the daily rollup
+    month = db.func.strftime("%Y-%m", Agg.date)
     monthly = (
         db.session.query(
-            db.func.strftime("%Y-%m", Interval.ts).label("month"),
-            db.func.sum(Interval.import_kwh).label("import_kwh"),
-            db.func.sum(Interval.export_kwh).label("export_kwh"),
-            db.func.sum(Interval.cost).label("net_cost"),
+            month.label("month"),
+            db.func.sum(Agg.import_kwh).label("import_kwh"),
+            db.func.sum(Agg.export_kwh).label("export_kwh"),
+            db.func.sum(Agg.cost).label("net_cost"),
+        )
+        .group_by(month)
+        .order_by(month.desc())
+        .all()
+    )
+
+    _agg_cache.update(key=latest, val=(daily, monthly))
+    return daily, monthly
+
+
+# Shared by the scheduler and /pull so two pulls never write at once
+_pull_lock = threading.Lock()
+
+
+def _locked_pull(user=None):
+    if not _pull_lock.acquire(blocking=False):
+        return {"status": "busy", "error": "A pull is already running"}
+    try:
+        result = pull_once(user)
+    finally:
+        _pull_lock.release()
+    _agg_cache.clear()
+    return result
+
+
+def scheduled_pull():
+    with app.app_context():
+        logger.info("Scheduled pull: %s", _locked_pull())
+
+
+scheduler = BackgroundScheduler()
+scheduler.add_job(
+    scheduled_pull,
+    "interval",
+    minutes=config.settings.PULL_MINUTES,
+    id="pull",
+    max_instances=1,
+    coalesce=True,
+    misfire_grace_time=300,
+)
+
+
+@app.route("/")
+def index():
+    # Latest 48 intervals (~24 hours)
+    # (only the columns the table shows, as plain rows rather than ORM objects)
+    intervals = (
+        db.session.query(
+            Interval.ts, Interval.import_kwh, Interval.export_kwh, Interval.cost
         )
-        .group_by(db.func.strftime("%Y-%m", Interval.ts))
-        .order_by(db.func.strftime("%Y-%m", Interval.ts).desc())
+        .order_by(Interval.ts.desc())
+        .limit(48)
         .all()
     )
 
-    user = UserConfig.query.get(1)
+    daily, monthly = _get_agg()
+
+    user = current_user()
     return render_template(
         "dashboard.html",
         intervals=intervals,
@@ -61,10 +153,13 @@ def index():
 
 @app.route("/settings", methods=["GET", "POST"])
 def settings():
-    user = UserConfig.query.get(1)
+    user = current_user()
     if request.method == "POST":
         user.api_key = request.form.get("api_key", "").strip()
         user.site_id = request.form.get("site_id", "").strip() or None
+        if user.site_id is None:
+            # A blanked Site ID asks for rediscovery, not the cached answer
+            forget_site_id(user.api_key)
         db.session.commit()
         return redirect(url_for("index"))
     return render_template("settings.html", user=user)
@@ -72,11 +167,12 @@ def settings():
 
 @app.route("/pull")
 def pull():
-    user = UserConfig.query.get(1)
-    result = pull_once(user)
-    print(result)
+    user = current_user()
+    result = _locked_pull(user)
+    logger.info("Manual pull: %s", result)
     return redirect(url_for("index"))
 
 
 if __name__ == "__main__":
+    scheduler.start()
     app.run(host="0.0.0.0", port=5000)
@@ -13,5 +13,7 @@ class Settings:
     REGION = os.getenv("REGION", "")
 
     PULL_MINUTES = int(os.getenv("PULL_MINUTES", "60"))
+    # Re-fetch the full 30-day window on every pull instead of just the tail
+    FULL_REBUILD = os.getenv("FULL_REBUILD", "0") == "1"
 
 settings = Settings()
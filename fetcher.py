@@ -1,155 +1,453 @@
+import hashlib
+import logging
+import pandas as pd
 import requests
-from datetime import datetime, timedelta
-from models import db, Interval
-import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+from time import monotonic
+from zoneinfo import ZoneInfo
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert
+from amber import AmberClient
+from config import settings
+from models import db, Interval, Agg, UserConfig
 
 
-def fetch_usage(api_key, site_id, channel_type, start_date, end_date):
-    """Fetch usage data from Amber API for a date range and channel type."""
-    url = f"https://api.amber.com.au/v1/sites/{site_id}/usage"
-    headers = {"Authorization": f"Bearer {api_key}"}
+logger = logging.getLogger("amber.fetcher")
+
+CHANNELS = ("general", "feedIn")
+AEST = ZoneInfo("Australia/Sydney")
+UPSERT_BATCH = 1000
+# Half-hourly intervals in a complete day
+INTERVALS_PER_DAY = 48
+
+# Sites whose usage endpoint rejected a multi-channel query
+_ONE_SHOT_UNSUPPORTED = set()
+
+# Sites the usage endpoint answered 404 for; pull_once() checks them
+_MISSING_SITES = set()
+
+# sha256(api_key) -> (site_id, discovered_at); saves the /sites call between pulls
+_SITE_CACHE = {}
+SITE_CACHE_TTL = 24 * 3600
+
+
+def _get_client(api_key):
+    """Reuse one AmberClient (and its connection pool) per API key."""
+    client = current_app.extensions.get("amber_client")
+    if client is None or client.api_key != api_key:
+        client = AmberClient(settings.AMBER_BASE_URL, api_key)
+        current_app.extensions["amber_client"] = client
+    return client
+
+
+def fetch_usage(client, site_id, channel_type, start_date, end_date):
+    """
+    Fetch usage data from Amber API for a date range and channel type.
+    Returns None when the request fails, so it is never mistaken for a
+    range with no data.
+    """
     params = {
         "channelType": channel_type,
         "startDate": start_date.strftime("%Y-%m-%d"),
         "endDate": end_date.strftime("%Y-%m-%d"),
     }
 
-    resp = requests.get(url, headers=headers, params=params)
-    if resp.status_code != 200:
-        print(f"[Amber] Error fetching {channel_type}: {resp.status_code} {resp.text}")
-        return []
-
     try:
-        data = resp.json()
-    except Exception as e:
-        print(f"[Amber] JSON decode error: {e}")
-        return []
+        data = client.usage(site_id, **params)
+    except requests.HTTPError as e:
+        logger.warning(
+            "Error fetching %s: %s %s", channel_type, e.response.status_code, e.response.text
+        )
+        if e.response.status_code == 404:
+            _MISSING_SITES.add(site_id)
+        return None
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Request error fetching %s: %s", channel_type, e)
+        return None
 
     # Amber always returns a list of dicts for usage data
     if isinstance(data, list):
         return data
     else:
-        print(f"[Amber] Unexpected data format for {channel_type}: {data}")
-        return []
+        logger.warning("Unexpected data format for %s: %s", channel_type, data)
+        return None
 
 
-def auto_discover_site_id(api_key):
-    """Fetch user's site ID from Amber API."""
-    url = "https://api.amber.com.au/v1/sites"
-    headers = {"Authorization": f"Bearer {api_key}"}
-    resp = requests.get(url, headers=headers)
-    if resp.status_code != 200:
-        print(f"[Amber] Error discovering site: {resp.status_code} {resp.text}")
+def fetch_all_channels_one_shot(client, site_id, channels, start_date, end_date):
+    """
+    Fetch several channels for one date range in a single request and split
+    the records by channelType. Returns None when the API will not serve
+    the combined query, so the caller can fall back to fetch_usage().
+    """
+    params = {
+        "channelType": ",".join(channels),
+        "startDate": start_date.strftime("%Y-%m-%d"),
+        "endDate": end_date.strftime("%Y-%m-%d"),
+    }
+
+    try:
+        data = client.usage(site_id, **params)
+    except requests.HTTPError as e:
+        if e.response.status_code in (400, 422):
+            _ONE_SHOT_UNSUPPORTED.add(site_id)
+        return None
+    except (requests.RequestException, ValueError):
+        return None
+
+    by_channel = {ch: [] for ch in channels}
+    if not isinstance(data, list):
+        return None
+    for rec in data:
+        ch = rec.get("channelType") if isinstance(rec, dict) else None
+        if ch is None:
+            # Records we cannot attribute to a channel: use per-channel calls
+            _ONE_SHOT_UNSUPPORTED.add(site_id)
+            return None
+        if ch in by_channel:
+            by_channel[ch].append(rec)
+    if not all(by_channel.values()):
+        # Empty, or a channel missing: the filter may have been ignored or
+        # misread, and a missing feedIn would be stored as zero exports
+        _ONE_SHOT_UNSUPPORTED.add(site_id)
         return None
+    return by_channel
 
+
+def auto_discover_site_id(client):
+    """Fetch user's site ID from Amber API."""
     try:
-        sites = resp.json()
-    except Exception as e:
-        print(f"[Amber] JSON decode error during site discovery: {e}")
+        sites = client.sites()
+    except requests.HTTPError as e:
+        logger.warning("Error discovering site: %s %s", e.response.status_code, e.response.text)
+        return None
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Request error during site discovery: %s", e)
         return None
 
     if isinstance(sites, list) and len(sites) > 0:
-        print(f"[Amber] Found active site ID: {sites[0].get('id')}")
+        logger.info("Found active site ID: %s", sites[0].get("id"))
         return sites[0].get("id")
-    print("[Amber] No active sites found.")
+    logger.warning("No active sites found.")
     return None
 
 
-def pull_once(user):
-    """Pull and store usage data in batches of up to 7 days."""
-    api_key = user.api_key
-    site_id = user.site_id or auto_discover_site_id(api_key)
+def _account_site_ids(client):
+    """Ids of every site on the account, or None if Amber could not be asked."""
+    try:
+        sites = client.sites()
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Request error listing sites: %s", e)
+        return None
+    if not isinstance(sites, list):
+        return None
+    return {s.get("id") for s in sites if isinstance(s, dict)}
+
+
+def _channel_frame(records, prefix):
+    """Flatten one channel's usage records into a ts/kwh/price DataFrame."""
+    rows = []
+    for rec in records:
+        try:
+            ts_raw = rec.get("interval") or rec.get("timestamp")
+            if not ts_raw:
+                continue
+            # Extract nested channel data
+            channels = rec.get("channels") or [None]
+            first = channels[0] or {}
+            rows.append((ts_raw, first.get("kwh"), first.get("price")))
+        except Exception as e:
+            logger.warning("Error processing record: %s", e)
+
+    values = [f"{prefix}_kwh", f"{prefix}_price"]
+    df = pd.DataFrame(rows, columns=["ts", *values])
+    # Coerce numbers column-wise; missing or malformed values become NaN -> 0.0.
+    # Cast explicitly so an empty channel still gives float columns, not object
+    df[values] = df[values].apply(pd.to_numeric, errors="coerce").astype("float64")
+    # A capped response's tail is re-fetched from its last (possibly partial)
+    # day, and the API may repeat records, so drop the repeats
+    return df.drop_duplicates("ts", keep="last")
+
+
+def _parse_ts(ts):
+    """Parse a column of Amber ISO 8601 strings into naive UTC timestamps."""
+    # Amber only sends ISO 8601, so name the format rather than have pandas infer it
+    return pd.to_datetime(ts, utc=True, format="ISO8601", errors="coerce").dt.tz_localize(None)
+
+
+def _update_aggregates(touched_days=None):
+    """
+    Refresh the daily Agg rows for the days touched by a pull.
+    With no days given, every day is rebuilt from a single GROUP BY.
+    """
+    if touched_days is not None and not touched_days:
+        return 0
+
+    day = db.func.date(Interval.ts)
+    query = db.session.query(
+        day,
+        db.func.sum(Interval.import_kwh),
+        db.func.sum(Interval.export_kwh),
+        db.func.sum(Interval.cost),
+    )
+    if touched_days is not None:
+        lo = datetime.combine(min(touched_days), time.min)
+        hi = datetime.combine(max(touched_days) + timedelta(days=1), time.min)
+        query = query.filter(Interval.ts >= lo, Interval.ts < hi)
+    totals = query.group_by(day).all()
+    if not totals:
+        return 0
+
+    rows = [
+        {
+            "date": date.fromisoformat(d),
+            "import_kwh": imp or 0.0,
+            "export_kwh": exp or 0.0,
+            "cost": cost or 0.0,
+        }
+        for d, imp, exp, cost in totals
+    ]
+    stmt = insert(Agg).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["date"],
+        set_={c: stmt.excluded[c] for c in ("import_kwh", "export_kwh", "cost")},
+    )
+    db.session.execute(stmt)
+    return len(rows)
+
+
+def rebuild_aggregates():
+    """Recompute every Agg row from the stored intervals."""
+    days = _update_aggregates()
+    db.session.commit()
+    return days
+
+
+def _site_cache_key(api_key):
+    # Key on a digest so the cache never holds the API key itself
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def forget_site_id(api_key):
+    """Drop the cached discovery for api_key so the next pull asks Amber again."""
+    _SITE_CACHE.pop(_site_cache_key(api_key), None)
+
 
-    if not api_key or not site_id:
+def _discover_site_id(client):
+    """auto_discover_site_id() behind a per-process TTL cache."""
+    key = _site_cache_key(client.api_key)
+    hit = _SITE_CACHE.get(key)
+    if hit and monotonic() - hit[1] < SITE_CACHE_TTL:
+        return hit[0]
+    site_id = auto_discover_site_id(client)
+    if site_id:
+        _SITE_CACHE[key] = (site_id, monotonic())
+    return site_id
+
+
+def _first_incomplete_day(start_date, last_day):
+    """First day from start_date up to last_day that is missing intervals."""
+    day = db.func.date(Interval.ts)
+    counts = dict(
+        db.session.query(day, db.func.count())
+        .filter(Interval.ts >= datetime.combine(start_date, time.min))
+        .group_by(day)
+        .all()
+    )
+    if not counts:
+        return last_day
+    # Days before the first stored one are history the site doesn't have,
+    # and that first day may itself start part-way through; neither is a gap
+    d = max(start_date, date.fromisoformat(min(counts)) + timedelta(days=1))
+    while d < last_day and counts.get(d.isoformat(), 0) >= INTERVALS_PER_DAY:
+        d += timedelta(days=1)
+    return d
+
+
+def _windows(start_date, end_date, batch):
+    # Amber's endDate is inclusive, so windows must not share a boundary day;
+    # otherwise every boundary day is fetched, and parsed, twice
+    windows = []
+    d1 = start_date
+    while d1 <= end_date:
+        windows.append((d1, min(d1 + batch - timedelta(days=1), end_date)))
+        d1 += batch
+    return windows
+
+
+def _truncated_at(records, end_date):
+    """
+    Local day of the newest record when the records stop well before
+    end_date (a capped response), otherwise None.
+    """
+    stamps = [rec.get("interval") or rec.get("timestamp") for rec in records]
+    newest = _parse_ts(pd.Series([s for s in stamps if s], dtype=object)).max()
+    if pd.isna(newest):
+        return None
+    newest = newest.tz_localize("UTC").tz_convert(AEST).date()
+    # The last two days may not have settled yet, so stopping there is normal
+    return newest if newest < end_date - timedelta(days=2) else None
+
+
+def _fetch_windows(client, site_id, windows):
+    """
+    Fetch every channel for each (start, end) window. Returns the records by
+    channel, and whether any request failed.
+    """
+    # The requests are independent and I/O-bound, so issue them all at once;
+    # wall time is then roughly the slowest single request
+    workers = min(len(windows) * len(CHANNELS), AmberClient.POOL_SIZE)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        # One request per window when the API takes every channel at once...
+        shots = [None] * len(windows)
+        if site_id not in _ONE_SHOT_UNSUPPORTED:
+            shots = list(
+                ex.map(
+                    lambda w: fetch_all_channels_one_shot(client, site_id, CHANNELS, *w),
+                    windows,
+                )
+            )
+        # ...otherwise one request per channel for the windows it refused
+        jobs = [(w, ch) for w, shot in zip(windows, shots) if shot is None for ch in CHANNELS]
+        results = list(
+            ex.map(lambda j: fetch_usage(client, site_id, j[1], *j[0]), jobs)
+        )
+
+    failed = any(chunk is None for chunk in results)
+    by_channel = {ch: [] for ch in CHANNELS}
+    fetched = [
+        ((w, ch), shot[ch]) for w, shot in zip(windows, shots) if shot is not None for ch in CHANNELS
+    ] + list(zip(jobs, results))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for ((d1, d2), channel), chunk in fetched:
+        if chunk is None:
+            continue
+        if debug:
+            logger.debug("%s returned %d records for %s → %s", channel, len(chunk), d1, d2)
+        by_channel[channel].extend(chunk)
+    return by_channel, failed
+
+
+def pull_once(user=None):
+    """Pull and store usage data, falling back to 7-day batches if needed."""
+    user = user or UserConfig.query.get(1)
+    api_key = user.api_key if user else None
+    if not api_key:
         return {"status": "error", "error": "Missing site_id or API key"}
 
+    client = _get_client(api_key)
+    site_id = user.site_id or _discover_site_id(client)
+
+    if not site_id:
+        return {"status": "error", "error": "Missing site_id or API key"}
+
+    # Persisted together with the intervals in the pull's single commit
     user.site_id = site_id
-    db.session.commit()
-    print(f"[Amber] Using site ID: {site_id}")
+    logger.info("Using site ID: %s", site_id)
 
-    end_date = datetime.utcnow().date()
+    # Stored timestamps are UTC; only the API's date range is a local calendar day
+    now_utc = datetime.now(timezone.utc)
+    end_date = now_utc.astimezone(AEST).date()
     start_date = end_date - timedelta(days=30)
+    # Settled history doesn't change: once backfilled, only re-fetch from a
+    # day before the first day with missing intervals (usually the newest
+    # one), which also picks up late revisions and refills any gaps
+    last = db.session.query(db.func.max(Interval.ts)).scalar()
+    if last is not None and not settings.FULL_REBUILD:
+        first_gap = _first_incomplete_day(start_date, last.date())
+        start_date = max(start_date, first_gap - timedelta(days=1))
     batch = timedelta(days=7)
 
-    all_general, all_feed = [], []
+    # Ask for the whole range in one go; the 7-day walk is only needed when
+    # the API refuses or truncates a wide range
+    logger.info("Fetching usage %s → %s", start_date, end_date)
+    one_shot_ok = site_id not in _ONE_SHOT_UNSUPPORTED
+    by_channel, failed = _fetch_windows(client, site_id, [(start_date, end_date)])
+    # (a 404 means the site itself is gone, which smaller windows won't fix)
+    if failed and end_date - start_date >= batch and site_id not in _MISSING_SITES:
+        logger.info("Wide fetch failed; retrying in 7-day batches")
+        if one_shot_ok:
+            # A rejection here may have been about the range, not the channels
+            _ONE_SHOT_UNSUPPORTED.discard(site_id)
+        by_channel, failed = _fetch_windows(client, site_id, _windows(start_date, end_date, batch))
+    elif not failed:
+        cut = _truncated_at(by_channel["general"], end_date)
+        if cut is not None:
+            # Keep what arrived and only walk the part the response left out
+            logger.info("Wide fetch stopped at %s; fetching the rest in 7-day batches", cut)
+            rest, failed = _fetch_windows(client, site_id, _windows(cut, end_date, batch))
+            for ch in CHANNELS:
+                by_channel[ch].extend(rest[ch])
 
-    print(f"[Amber] Fetching usage {start_date} → {end_date} in 7-day batches")
+    if failed:
+        if site_id in _MISSING_SITES:
+            _MISSING_SITES.discard(site_id)
+            # A site the account no longer lists will never answer again;
+            # forget it so the next pull discovers a current one
+            live = _account_site_ids(client)
+            if live is not None and site_id not in live:
+                logger.warning("Site %s is no longer on this account; clearing it.", site_id)
+                user.site_id = None
+                forget_site_id(api_key)
+        # A missing channel would be merged in as zeros and overwrite good
+        # rows, so store nothing and let the next pull retry the whole range
+        logger.warning("A usage request failed; skipping this pull.")
+        db.session.commit()
+        return {"status": "error", "error": "Usage request to Amber failed"}
 
-    d1 = start_date
-    while d1 < end_date:
-        d2 = min(d1 + batch, end_date)
-        gen_chunk = fetch_usage(api_key, site_id, "general", d1, d2)
-        feed_chunk = fetch_usage(api_key, site_id, "feedIn", d1, d2)
-        print(f"[Amber] general returned {len(gen_chunk)} records for {d1} → {d2}")
-        print(f"[Amber] feedIn returned {len(feed_chunk)} records for {d1} → {d2}")
-        all_general.extend(gen_chunk)
-        all_feed.extend(feed_chunk)
-        d1 += batch
+    all_general, all_feed = by_channel["general"], by_channel["feedIn"]
 
-    print(f"[Amber] Total fetched: {len(all_general)} general, {len(all_feed)} feedIn")
+    logger.info("Total fetched: %d general, %d feedIn", len(all_general), len(all_feed))
 
     if len(all_general) == 0:
-        print("[Amber] No data returned. Check API key validity or date range.")
+        logger.warning("No data returned. Check API key validity or date range.")
+        db.session.commit()
         return {"status": "ok", "count": 0}
 
-    db.session.rollback()
-    stored = 0
-
-    for i, gen_rec in enumerate(all_general):
-        try:
-            ts_raw = gen_rec.get("interval") or gen_rec.get("timestamp")
-            if not ts_raw:
-                continue
-            ts = datetime.fromisoformat(ts_raw.replace("Z", "+00:00"))
-
-            # Extract nested channel data
-            gen_channels = gen_rec.get("channels", [])
-            feed_channels = (
-                all_feed[i].get("channels", []) if i < len(all_feed) else []
-            )
+    # Join the channels on the raw timestamp strings, which both channels
+    # share, so each interval's timestamp is parsed once rather than twice
+    df = _channel_frame(all_general, "import").merge(
+        _channel_frame(all_feed, "export"), on="ts", how="left"
+    ).fillna(0.0)
+    df["ts"] = _parse_ts(df["ts"])
+    df = df.dropna(subset=["ts"]).drop_duplicates("ts", keep="last")
+    # Cost weighting fix (Amber uses per-interval price not total avg)
+    df["cost"] = (
+        df["import_kwh"] * df["import_price"] - df["export_kwh"] * df["export_price"]
+    ).round(6)
 
-            import_kwh = (
-                gen_channels[0].get("kwh") if gen_channels and gen_channels[0] else 0.0
-            )
-            export_kwh = (
-                feed_channels[0].get("kwh") if feed_channels and feed_channels[0] else 0.0
-            )
-            import_price = (
-                gen_channels[0].get("price")
-                if gen_channels and gen_channels[0]
-                else 0.0
-            )
-            export_price = (
-                feed_channels[0].get("price")
-                if feed_channels and feed_channels[0]
-                else 0.0
+    rows = df.to_dict("records")
+    stored = 0
+    try:
+        cols = ("import_kwh", "export_kwh", "import_price", "export_price", "cost")
+        # Batches keep each statement well under the bound-parameter limit
+        for i in range(0, len(rows), UPSERT_BATCH):
+            stmt = insert(Interval).values(rows[i:i + UPSERT_BATCH])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["ts"],
+                set_={c: stmt.excluded[c] for c in cols},
+                # Leave rows Amber reported unchanged alone, so rowcount
+                # counts only new or revised intervals
+                where=db.or_(
+                    *(Interval.__table__.c[c].is_distinct_from(stmt.excluded[c]) for c in cols)
+                ),
             )
+            stored += db.session.execute(stmt).rowcount
+        touched_days = {ts.date() for ts in df["ts"]}
 
-            # Cost weighting fix (Amber uses per-interval price not total avg)
-            cost = round((import_kwh * import_price) - (export_kwh * export_price), 6)
-
-            existing = Interval.query.get(ts)
-            if not existing:
-                existing = Interval(
-                    ts=ts,
-                    import_kwh=import_kwh,
-                    export_kwh=export_kwh,
-                    import_price=import_price,
-                    export_price=export_price,
-                    cost=cost,
-                )
-                db.session.add(existing)
-                stored += 1
-            else:
-                existing.import_kwh = import_kwh
-                existing.export_kwh = export_kwh
-                existing.import_price = import_price
-                existing.export_price = export_price
-                existing.cost = cost
+        # Nothing new and every day already rolled up: the Agg rows are current
+        if stored == 0:
+            known = {
+                d for (d,) in db.session.query(Agg.date).filter(Agg.date.in_(touched_days))
+            }
+            if touched_days <= known:
+                touched_days = set()
 
-        except Exception as e:
-            print(f"[Amber] Error processing record: {e}")
-
-    db.session.commit()
-    print(f"[Amber] Stored {stored} intervals.")
+        days = _update_aggregates(touched_days)
+        logger.info("Refreshed aggregates for %d days.", days)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info("Stored %d new or changed intervals.", stored)
     return {"status": "ok", "count": stored}
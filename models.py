@@ -20,7 +20,7 @@ class Interval(db.Model):
     __tablename__ = "interval"
 
     id = db.Column(db.Integer, primary_key=True)
-    ts = db.Column(db.DateTime, unique=True, index=True)
+    ts = db.Column(db.DateTime, unique=True, index=True, nullable=False)
     import_kwh = db.Column(db.Float, default=0.0)
     export_kwh = db.Column(db.Float, default=0.0)
     import_price = db.Column(db.Float, default=0.0)
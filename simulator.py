@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import Dict, List
 import math
+import numpy as np
 
 # Very simple daylight bell-curve profile for PV (per kW of DC capacity)
 # Returns kWh produced in the interval, assuming 30-min intervals.
@@ -18,60 +19,87 @@ def pv_profile_kwh(ts: datetime, solar_kw: float) -> float:
     return max(val_kw * 0.5, 0.0)
 
 
+def pv_profile_kwh_array(hours: np.ndarray, solar_kw: float) -> np.ndarray:
+    # pv_profile_kwh over an array of fractional hours-of-day
+    if solar_kw <= 0:
+        return np.zeros_like(hours)
+    sigma = 3.0
+    val_kw = solar_kw * np.exp(-0.5 * ((hours - 13)/sigma)**2)
+    return np.where((hours >= 7) & (hours <= 19), val_kw * 0.5, 0.0)
+
+
+# kWh per kW installed for each half-hour slot of the day; PV only depends on
+# time of day, so simulate() indexes this instead of evaluating exp() per interval
+_PV_PER_KW = pv_profile_kwh_array(np.arange(48) * 0.5, 1.0)
+
+
+def _battery_dispatch(net: np.ndarray, battery_kwh: float, batt_eff: float) -> np.ndarray:
+    # State of charge depends on the previous interval, so this part stays a loop;
+    # it runs over plain floats, as indexing numpy arrays per element is far slower
+    soc = 0.0
+    out = net.tolist()
+    for i, n in enumerate(out):
+        # Battery logic: if net > 0, try to discharge to cover; if net < 0, charge from surplus
+        if n > 0 and soc > 0:
+            discharge = min(n, soc)  # kWh available this interval
+            n -= discharge
+            soc -= discharge
+            # discharge losses already occurred when charging; keep simple here
+        elif n < 0 and soc < battery_kwh:
+            surplus = -n
+            room = battery_kwh - soc
+            charge = min(surplus, room) * batt_eff
+            soc += charge
+            n += charge  # reduce export by charging
+        out[i] = n
+    return np.array(out, dtype=float)
+
+
 def simulate(intervals: List[dict], solar_kw: float, battery_kwh: float, batt_eff: float = 0.9):
     """
     intervals: list of {ts, import_kwh, export_kwh, import_price, export_price}
     returns: dict with totals and per-interval simulated costs
     """
-    soc = 0.0
-    results = []
-    orig_cost = 0.0
-    new_cost = 0.0
-
-    for it in intervals:
-        ts = it['ts']
-        load = it['import_kwh'] - it['export_kwh']  # net load before PV; if negative, net export
-        pv = pv_profile_kwh(ts, solar_kw)
-        net = load - pv
-
-        # Battery logic: if net > 0, try to discharge to cover; if net < 0, charge from surplus
-        if battery_kwh > 0:
-            if net > 0 and soc > 0:
-                discharge = min(net, soc)  # kWh available this interval
-                net -= discharge
-                soc -= discharge
-                # discharge losses already occurred when charging; keep simple here
-            elif net < 0 and soc < battery_kwh:
-                surplus = -net
-                room = battery_kwh - soc
-                charge = min(surplus, room) * batt_eff
-                soc += charge
-                net += charge  # reduce export by charging
+    n = len(intervals)
+    ts = [it['ts'] for it in intervals]
+    imp = np.fromiter((it['import_kwh'] for it in intervals), dtype=float, count=n)
+    exp = np.fromiter((it['export_kwh'] for it in intervals), dtype=float, count=n)
+    ip = np.fromiter((it.get('import_price', 0.0) for it in intervals), dtype=float, count=n)
+    ep = np.fromiter((it.get('export_price', 0.0) for it in intervals), dtype=float, count=n)
+    slots = np.fromiter((t.hour*2 + t.minute//30 for t in ts), dtype=np.intp, count=n)
+    pv = _PV_PER_KW[slots] * solar_kw if solar_kw > 0 else np.zeros(n)
 
-        # net > 0 means import required; net < 0 means export
-        import_kwh = max(net, 0.0)
-        export_kwh = max(-net, 0.0)
+    # net load before PV is import - export; if negative, net export
+    net = imp - exp - pv
+    if battery_kwh > 0:
+        net = _battery_dispatch(net, battery_kwh, batt_eff)
 
-        # prices
-        ip = it.get('import_price', 0.0)
-        ep = it.get('export_price', 0.0)
+    # net > 0 means import required; net < 0 means export
+    new_imp = np.maximum(net, 0.0)
+    new_exp = np.maximum(-net, 0.0)
 
-        # costs
-        baseline = it['import_kwh'] * ip - it['export_kwh'] * ep
-        scenario = import_kwh * ip - export_kwh * ep
+    # costs
+    baseline = imp * ip - exp * ep
+    scenario = new_imp * ip - new_exp * ep
 
-        orig_cost += baseline
-        new_cost += scenario
-        results.append({
-            'ts': ts,
-            'import_kwh': import_kwh,
-            'export_kwh': export_kwh,
-            'import_price': ip,
-            'export_price': ep,
-            'baseline_cost': baseline,
-            'scenario_cost': scenario
-        })
+    results = [
+        {
+            'ts': t,
+            'import_kwh': i,
+            'export_kwh': e,
+            'import_price': p_in,
+            'export_price': p_out,
+            'baseline_cost': b,
+            'scenario_cost': c
+        }
+        for t, i, e, p_in, p_out, b, c in zip(
+            ts, new_imp.tolist(), new_exp.tolist(), ip.tolist(), ep.tolist(),
+            baseline.tolist(), scenario.tolist()
+        )
+    ]
 
+    orig_cost = float(baseline.sum())
+    new_cost = float(scenario.sum())
     return {
         'intervals': results,
         'baseline_total': orig_cost,
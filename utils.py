@@ -1,20 +1,35 @@
-from collections import defaultdict
-from datetime import datetime
+import pandas as pd
+from models import db, Interval
+
+
+def load_intervals_df(start=None, end=None):
+    # Column-only read straight into a DataFrame, no ORM object per row
+    q = db.select(Interval.ts, Interval.import_kwh, Interval.export_kwh, Interval.cost)
+    if start is not None:
+        q = q.where(Interval.ts >= start)
+    if end is not None:
+        q = q.where(Interval.ts <= end)
+    with db.engine.connect() as conn:
+        return pd.read_sql(q.order_by(Interval.ts), conn, parse_dates=["ts"])
 
 
 def aggregate_cost(intervals):
-    buckets = {
-        'daily': defaultdict(float),
-        'monthly': defaultdict(float),
-        'quarterly': defaultdict(float),
-        'yearly': defaultdict(float)
-    }
-    for it in intervals:
-        ts = it.ts
-        dkey = ts.date().isoformat()
-        mkey = f"{ts.year}-{ts.month:02d}"
-        qkey = f"{ts.year}-Q{((ts.month-1)//3)+1}"
-        ykey = str(ts.year)
-        for key, b in [(dkey,'daily'), (mkey,'monthly'), (qkey,'quarterly'), (ykey,'yearly')]:
-            buckets[b][key] += it.cost
-    return {k: dict(v) for k, v in buckets.items()}
+    # Accepts a DataFrame from load_intervals_df() or an iterable of Interval rows
+    if isinstance(intervals, pd.DataFrame):
+        ts = pd.DatetimeIndex(intervals['ts'])
+        cost = pd.Series(intervals['cost'].to_numpy(dtype=float), index=ts)
+    else:
+        ts = pd.DatetimeIndex([it.ts for it in intervals])
+        cost = pd.Series([it.cost for it in intervals], index=ts, dtype=float)
+    # Group on integer-backed periods and only stringify the resulting keys
+    buckets = {}
+    for b, freq in [('daily', 'D'), ('monthly', 'M'), ('quarterly', 'Q'), ('yearly', 'Y')]:
+        sums = cost.groupby(ts.to_period(freq)).sum()
+        buckets[b] = {_period_key(p): float(v) for p, v in sums.items()}
+    return buckets
+
+
+def _period_key(p):
+    if p.freqstr.startswith('Q'):
+        return f"{p.year}-Q{p.quarter}"
+    return str(p)